@@ -1,21 +1,58 @@
 # bot.py
-# aiogram>=3.4,<4  |  FFmpeg должен быть в PATH
+# aiogram>=3.4,<4  |  FFmpeg должен быть в PATH; ffprobe желателен (без него всё перекодируется целиком)
 import asyncio
 import json
 import logging
 import os
+import re
+import secrets
+import shutil
+import struct
+import subprocess
 import tempfile
+import time
+import uuid
+import weakref
+from collections import OrderedDict, deque
 from pathlib import Path
-from typing import Optional, Dict, Any, Set, Tuple
+from typing import (
+    Optional, Dict, Any, Set, Tuple, FrozenSet, Deque, Union, Callable, Awaitable, List, Iterable,
+    AsyncIterator,
+)
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:  # необязательная зависимость — без неё работает stdlib json
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # необязательная зависимость — без неё access.json разбирается через json
+    msgspec = None
 
-from aiogram import Bot, Dispatcher, F
+from aiohttp import ClientResponseError, web
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
+from aiogram.dispatcher.flags import get_flag
 from aiogram.enums import ChatAction
-from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.types import (
     Message,
+    Video,
+    Document,
+    Animation,
+    File,
     ReplyKeyboardMarkup,
     KeyboardButton,
     FSInputFile,
+    BufferedInputFile,
+    InputFile,
 )
 
 # ---------- ЛОГИ ----------
@@ -27,71 +64,243 @@ log = logging.getLogger("video_circle_bot")
 DATA_DIR = Path("data")
 DATA_DIR.mkdir(exist_ok=True)
 ACCESS_FILE = DATA_DIR / "access.json"
+# Рабочие файлы видео (вход/выход ffmpeg). По умолчанию — в RAM (tmpfs /dev/shm), мимо диска,
+# если там достаточно места: в контейнерах /dev/shm часто всего 64 МБ. BOT_TMP — свой каталог.
+SHM_MIN_FREE = 512 * 1024 * 1024
+
+def _default_tmp() -> str:
+    try:
+        if shutil.disk_usage("/dev/shm").free >= SHM_MIN_FREE:
+            return "/dev/shm"
+    except OSError:
+        pass
+    return tempfile.gettempdir()
+
+TMP_ROOT = Path(os.environ.get("BOT_TMP") or _default_tmp()) / "video_circle_bot"
+TMP_ROOT.mkdir(parents=True, exist_ok=True)
 SAVE_LOCK = asyncio.Lock()
+# BOT_ACCESS_PRETTY=1 — писать access.json с отступами (удобно править руками)
+ACCESS_PRETTY = os.environ.get("BOT_ACCESS_PRETTY") == "1"
+# изменения прав сразу видны из кэша, а на диск пишутся пачкой через столько секунд
+ACCESS_FLUSH_DELAY = 0.5
+ACCESS_FLUSH_RETRY_DELAY = 5.0
+_ACCESS_DIRTY = asyncio.Event()
 
-def _parse_ids(env: Optional[str]) -> Set[int]:
-    ids: Set[int] = set()
-    if not env:
-        return ids
-    for part in env.split(","):
-        part = part.strip()
-        if not part:
-            continue
-        try:
-            ids.add(int(part))
-        except ValueError:
-            pass
-    return ids
+_ID_RE = re.compile(rb"-?\d+")
 
-def _empty_access() -> Dict[str, Any]:
-    # username — без @, в нижнем регистре
-    return {
-        "super": {"ids": [], "usernames": []},
-        "admins": {"ids": [], "usernames": []},
-    }
+# разбор JSON из bytes: orjson (C, без промежуточной str), иначе stdlib
+_json_loads: Callable[[bytes], Any] = orjson.loads if orjson is not None else json.loads
+
+def _parse_ids(env: Optional[str]) -> FrozenSet[int]:
+    # все числа из строки за один проход регэкспа: "1, 2;3" -> {1, 2, 3}
+    return frozenset(int(m) for m in _ID_RE.findall((env or "").encode()))
 
-def _normalize_access(d: Dict[str, Any]) -> Dict[str, Any]:
-    def norm_block(b: Dict[str, Any]) -> Dict[str, Any]:
+# начальные роли, пока access.json нет; окружение не меняется — разбираем один раз
+ENV_SUPER_ADMINS = _parse_ids(os.environ.get("BOT_SUPER_ADMINS"))
+ENV_ADMINS = _parse_ids(os.environ.get("BOT_ADMINS"))
+
+def _make_block(ids: Iterable[int], unames: Iterable[str]) -> Dict[str, Any]:
+    # в памяти — только frozenset для проверок прав на каждом сообщении;
+    # сортируются они лишь при записи файла и для /list_roles
+    return {"ids_set": frozenset(ids), "usernames_set": frozenset(unames)}
+
+def _normalize_access(d: Any) -> Dict[str, Any]:
+    # Терпимый разбор: берём только блоки super/admins, всё прочее в файле игнорируем;
+    # блок или список не того типа (null, [], строка) считаем пустым.
+    def as_list(v: Any) -> List[Any]:
+        return v if isinstance(v, list) else []
+
+    def norm_block(b: Any) -> Dict[str, Any]:
+        if not isinstance(b, dict):
+            b = {}
         # ids -> ints уникальные
         ids = set()
-        for v in b.get("ids", []):
+        for v in as_list(b.get("ids")):
             try:
                 ids.add(int(v))
             except Exception:
                 pass
         # usernames -> строки без @, lower
-        unames = {str(u).lstrip("@").lower() for u in b.get("usernames", []) if u}
-        return {"ids": sorted(ids), "usernames": sorted(unames)}
+        unames = {str(u).lstrip("@").lower() for u in as_list(b.get("usernames")) if u}
+        return _make_block(ids, unames)
 
     if not isinstance(d, dict):
-        return _empty_access()
-    d.setdefault("super", {})
-    d.setdefault("admins", {})
-    d["super"] = norm_block(d["super"])
-    d["admins"] = norm_block(d["admins"])
-    return d
-
-def _load_access() -> Dict[str, Any]:
-    if not ACCESS_FILE.exists():
+        d = {}
+    return {"super": norm_block(d.get("super")), "admins": norm_block(d.get("admins"))}
+
+def _serialize_access(d: Dict[str, Any]) -> Dict[str, Any]:
+    # на диск — отсортированные списки; сортировка одна на запись файла, а не на команду
+    return {
+        name: {"ids": sorted(block["ids_set"]), "usernames": sorted(block["usernames_set"])}
+        for name, block in d.items()
+    }
+
+if msgspec is not None:
+    # Схема access.json: разбор и проверка типов за один проход в C, без промежуточных dict.
+    class AccessBlock(msgspec.Struct):
+        ids: List[int] = []
+        usernames: List[str] = []
+
+    class Access(msgspec.Struct):
+        super: AccessBlock = msgspec.field(default_factory=AccessBlock)
+        admins: AccessBlock = msgspec.field(default_factory=AccessBlock)
+
+    # strict=False: "123" в ids тоже принимается как число
+    _ACCESS_DECODER = msgspec.json.Decoder(Access, strict=False)
+
+def _parse_access(raw: bytes) -> Dict[str, Any]:
+    if msgspec is not None:
+        try:
+            acc = _ACCESS_DECODER.decode(raw)
+        except msgspec.DecodeError:
+            pass  # битый JSON или мусор в списках — терпимый разбор ниже
+        else:
+            return {
+                name: _make_block(b.ids, (u.lstrip("@").lower() for u in b.usernames if u))
+                for name, b in (("super", acc.super), ("admins", acc.admins))
+            }
+    # невалидный JSON — ValueError наверх: пустые роли вместо битого файла молча отобрали бы доступ у всех
+    return _normalize_access(_json_loads(raw))
+
+# Ключ версии файла: mtime + размер + inode. Одного mtime мало — на ФС с грубым временем
+# (FAT, часть сетевых) правка в ту же секунду, что и запись ботом, осталась бы незамеченной;
+# os.replace в _atomic_write всегда меняет inode.
+FileKey = Tuple[int, int, int]
+
+def _file_key(st: os.stat_result) -> FileKey:
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+# (ключ файла или None, если файла нет) -> нормализованный доступ
+_ACCESS_CACHE: Optional[Tuple[Optional[FileKey], Dict[str, Any]]] = None
+
+def _copy_access(d: Dict[str, Any]) -> Dict[str, Any]:
+    # команды переприсваивают списки внутри блоков — копии блоков достаточно, чтобы не портить кэш
+    return {name: dict(block) for name, block in d.items()}
+
+def _read_access(exists: bool) -> Dict[str, Any]:
+    if not exists:
         # первичное заполнение из переменных окружения
-        acc = _empty_access()
-        super_ids = _parse_ids(os.environ.get("BOT_SUPER_ADMINS"))
-        admin_ids = _parse_ids(os.environ.get("BOT_ADMINS"))
-        acc["super"]["ids"] = sorted(super_ids)
-        acc["admins"]["ids"] = sorted(admin_ids)
-        return acc
+        return {
+            "super": _make_block(ENV_SUPER_ADMINS, ()),
+            "admins": _make_block(ENV_ADMINS, ()),
+        }
     try:
-        data = json.loads(ACCESS_FILE.read_text(encoding="utf-8"))
-    except Exception:
-        data = _empty_access()
-    return _normalize_access(data)
+        raw = ACCESS_FILE.read_bytes()
+    except OSError:
+        raw = b""
+    return _parse_access(raw)
+
+async def _load_access() -> Dict[str, Any]:
+    # Файл перечитывается только когда он поменялся (правка руками или _save_access).
+    # stat на каждом апдейте дешевле прыжка в поток, а чтение и разбор при промахе — в потоке.
+    global _ACCESS_CACHE
+    if _ACCESS_CACHE is not None and (_ACCESS_DIRTY.is_set() or SAVE_LOCK.locked()):
+        # в кэше есть ещё не записанные изменения — они новее файла (а во время записи
+        # os.replace меняет ключ раньше, чем _flush_access его запомнит)
+        return _copy_access(_ACCESS_CACHE[1])
+    try:
+        key: Optional[FileKey] = _file_key(os.stat(ACCESS_FILE))
+    except OSError:
+        key = None
+    start = _ACCESS_CACHE
+    if start is None or start[0] != key:
+        try:
+            data = await asyncio.to_thread(_read_access, key is not None)
+        except ValueError:
+            # остаёмся на последних прочитанных ролях (или ролях из окружения);
+            # ключ запоминаем, так что предупреждение — одно на версию файла
+            log.warning("%s is not valid JSON, keeping the previous roles", ACCESS_FILE)
+            data = start[1] if start is not None else _read_access(False)
+        # пока читали, кэш мог смениться (команда или запись) — тогда прочитанное уже устарело
+        if _ACCESS_CACHE is start:
+            _ACCESS_CACHE = (key, data)
+    return _copy_access(_ACCESS_CACHE[1])
+
+def _atomic_write(path: Path, data: bytes, durable: bool = True) -> None:
+    # пишем во временный файл и подменяем им основной: при падении процесса файл либо старый, либо новый.
+    # durable=False — без fsync: для данных, которые не жалко потерять при сбое питания (кэш)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        if durable:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _dump_access(d: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        # orjson сразу отдаёт UTF-8 байты
+        option = orjson.OPT_SORT_KEYS | (orjson.OPT_INDENT_2 if ACCESS_PRETTY else 0)
+        return orjson.dumps(d, option=option)
+    if ACCESS_PRETTY:
+        text = json.dumps(d, ensure_ascii=False, sort_keys=True, indent=2)
+    else:
+        text = json.dumps(d, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return text.encode("utf-8")
+
+def _write_access(d: Dict[str, Any]) -> FileKey:
+    # выполняется в потоке: сортировка, сериализация и запись не держат event loop.
+    # d из кэша не меняется на месте (_save_access подменяет его целиком), так что читать его здесь безопасно
+    _atomic_write(ACCESS_FILE, _dump_access(_serialize_access(d)))
+    return _file_key(os.stat(ACCESS_FILE))
 
 async def _save_access(data: Dict[str, Any]) -> None:
+    # Новое состояние сразу становится текущим (кэш), запись на диск — в _access_flush_loop:
+    # серия /grant_* подряд даёт одну запись файла, а не по одной на команду.
+    global _ACCESS_CACHE
+    # команды переприсваивают только *_set в своей копии — её и делаем текущим состоянием
+    key = _ACCESS_CACHE[0] if _ACCESS_CACHE else None
+    _ACCESS_CACHE = (key, _copy_access(data))
+    _ACCESS_DIRTY.set()
+
+async def _flush_access() -> None:
+    global _ACCESS_CACHE
     async with SAVE_LOCK:
-        ACCESS_FILE.write_text(
-            json.dumps(_normalize_access(data), ensure_ascii=False, indent=2),
-            encoding="utf-8",
-        )
+        _ACCESS_DIRTY.clear()
+        try:
+            key = await asyncio.to_thread(_write_access, _ACCESS_CACHE[1])
+        except BaseException:
+            # не записали — изменения по-прежнему только в кэше
+            _ACCESS_DIRTY.set()
+            raise
+        # если за время записи были новые изменения, они в кэше, а флаг уже снова поднят
+        _ACCESS_CACHE = (key, _ACCESS_CACHE[1])
+
+async def _access_flush_loop() -> None:
+    while True:
+        await _ACCESS_DIRTY.wait()
+        await asyncio.sleep(ACCESS_FLUSH_DELAY)
+        # shield: отмена цикла при остановке не обрывает уже начатую запись
+        try:
+            await asyncio.shield(_flush_access())
+        except Exception:
+            # диск полон, файл занят (Windows) и т.п.: флаг снова поднят — повторим позже
+            log.exception("Failed to write %s, will retry", ACCESS_FILE)
+            await asyncio.sleep(ACCESS_FLUSH_RETRY_DELAY)
+
+_flush_task: Optional["asyncio.Task[None]"] = None
+
+async def _start_access_flusher() -> None:
+    global _flush_task
+    _flush_task = asyncio.create_task(_access_flush_loop())
+
+async def _stop_access_flusher() -> None:
+    if _flush_task is not None:
+        _flush_task.cancel()
+        try:
+            await _flush_task
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # ошибка уже в прошлом — несохранённое всё равно попробуем записать ниже
+            log.exception("Access flusher failed")
+    async with SAVE_LOCK:  # дождаться записи, если она идёт прямо сейчас
+        pass
+    if _ACCESS_DIRTY.is_set():
+        try:
+            await _flush_access()
+        except Exception:
+            log.exception("Failed to write %s on shutdown, role changes are lost", ACCESS_FILE)
 
 # ---------- РОЛИ/ПРАВА ----------
 def _user_username_norm(m: Message) -> Optional[str]:
@@ -101,202 +310,912 @@ def _user_username_norm(m: Message) -> Optional[str]:
     return u.username.lstrip("@").lower()
 
 def _in_block(m: Message, block: Dict[str, Any]) -> bool:
-    uid = m.from_user.id
-    uname = _user_username_norm(m)
-    if uid in set(block.get("ids", [])):
-        return True
-    if uname and (uname in set(block.get("usernames", []))):
+    # без from_user (анонимный админ группы, сообщение от имени канала) — ролей нет
+    if m.from_user is None:
+        return False
+    # сначала дешёвая проверка по id; username нормализуем, только если id не нашёлся
+    if m.from_user.id in block["ids_set"]:
         return True
-    return False
+    uname = _user_username_norm(m)
+    return uname is not None and uname in block["usernames_set"]
 
 def is_super(m: Message, access: Dict[str, Any]) -> bool:
-    return _in_block(m, access.get("super", {}))
+    return _in_block(m, access["super"])
 
 def is_admin(m: Message, access: Dict[str, Any]) -> bool:
     # супер-админ автоматически админ
-    return is_super(m, access) or _in_block(m, access.get("admins", {}))
+    return is_super(m, access) or _in_block(m, access["admins"])
 
-async def _ensure_admin_access_or_explain(m: Message) -> Tuple[bool, Dict[str, Any]]:
-    access = _load_access()
-    if is_admin(m, access):
-        return True, access
-    who = f"@{m.from_user.username}" if m.from_user.username else f"id:{m.from_user.id}"
+async def _explain_no_access(m: Message) -> None:
+    u = m.from_user
+    if u is None:
+        who = f"chat:{m.chat.id} (анонимно)"
+    else:
+        who = f"@{u.username}" if u.username else f"id:{u.id}"
     await m.answer(
         "⛔ Доступ запрещён.\n"
         "Только админы могут пользоваться ботом.\n\n"
         f"Ваш идентификатор: {who}"
     )
-    return False, access
+
+class AuthMiddleware(BaseMiddleware):
+    # Права считаются один раз на апдейт и попадают в data: access, is_super, is_admin.
+    # Обработчики с флагом admin=True без роли не вызываются — сразу отвечаем отказом.
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any],
+    ) -> Any:
+        access = await _load_access()
+        sup = is_super(event, access)
+        adm = sup or _in_block(event, access["admins"])
+        data["access"] = access
+        data["is_super"] = sup
+        data["is_admin"] = adm
+        if not adm and get_flag(data, "admin"):
+            await _explain_no_access(event)
+            return None
+        return await handler(event, data)
 
 def _require_super(func):
-    async def wrapper(m: Message, *args, **kwargs):
-        access = _load_access()
+    # access приходит из AuthMiddleware через обработчик
+    async def wrapper(m: Message, access: Dict[str, Any], *args, **kwargs):
         if not is_super(m, access):
             await m.answer("⛔ Команда доступна только супер-админам.")
             return
         return await func(m, access, *args, **kwargs)
     return wrapper
 
+# ---------- ТЕКСТЫ ----------
+BTN_CONVERT = "🎥 Конвертировать видео"
+BTN_HELP = "ℹ️ Помощь"
+WELCOME_TEXT = (
+    "Отправь видео — сделаю кружок Telegram.\n\n"
+    "Роли:\n"
+    "• Супер-админ — команды и конвертация\n"
+    "• Админ — только конвертация\n"
+    "• Остальным — доступ закрыт"
+)
+PROMPT_TEXT = "Жду видео или пересланное видео."
+HELP_TEXT = "Установи ffmpeg. Доступ только для ролей (админ/супер-админ)."
+
 # ---------- КЛАВИАТУРА ----------
 MAIN_KB = ReplyKeyboardMarkup(
     keyboard=[
-        [KeyboardButton(text="🎥 Конвертировать видео")],
-        [KeyboardButton(text="ℹ️ Помощь")],
+        [KeyboardButton(text=BTN_CONVERT)],
+        [KeyboardButton(text=BTN_HELP)],
     ],
     resize_keyboard=True,
 )
 
 # ---------- FFmpeg ----------
-async def ffmpeg_convert(src: Path, dst: Path) -> None:
-    # Без кавычек/min(): масштабируем с сохранением пропорций и дополняем паддингом до квадрата
+def _ffmpeg_names(kind: str) -> FrozenSet[str]:
+    # имена из `ffmpeg -encoders` / `ffmpeg -filters`; вызывается один раз при старте
+    try:
+        out = subprocess.run(
+            ["ffmpeg", "-hide_banner", f"-{kind}"],
+            capture_output=True, text=True, timeout=15,
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        return frozenset()
+    return frozenset(p[1] for p in (line.split() for line in out.splitlines()) if len(p) > 1)
+
+FFMPEG_ENCODERS = _ffmpeg_names("encoders")
+
+# NVENC: пресеты p1 (быстрее) … p7 (качественнее); tune zerolatency с nvenc не совместим.
+_NVENC_ARGS: Tuple[str, ...] = (
+    "-c:v", "h264_nvenc", "-preset", "p4", "-tune", "hq",
+    "-rc", "vbr", "-cq", "23", "-b:v", "1M", "-maxrate", "2M",
+    "-profile:v", "main", "-level", "3.1",
+)
+# Intel Quick Sync: принимает только nv12/p010
+_QSV_ARGS: Tuple[str, ...] = (
+    "-c:v", "h264_qsv", "-preset", "veryfast", "-global_quality", "25",
+    "-profile:v", "main", "-pix_fmt", "nv12",
+)
+# macOS: realtime — подсказка кодеру не тратить время на качество
+_VIDEOTOOLBOX_ARGS: Tuple[str, ...] = (
+    "-c:v", "h264_videotoolbox", "-b:v", "1M", "-realtime", "1",
+    "-profile:v", "main", "-pix_fmt", "yuv420p",
+)
+_VAAPI_ARGS: Tuple[str, ...] = ("-c:v", "h264_vaapi", "-qp", "25", "-profile:v", "main")
+VAAPI_DEVICE = os.environ.get("BOT_VAAPI_DEVICE", "/dev/dri/renderD128")
+
+# Одновременных ffmpeg не больше FFMPEG_WORKERS; потоки декодера, фильтров и x264
+# делим между ними, чтобы в сумме не выходить за число ядер.
+FFMPEG_WORKERS = max(1, int(os.environ.get("BOT_FFMPEG_CONCURRENCY") or min(os.cpu_count() or 2, 4)))
+FFMPEG_THREADS = max(1, (os.cpu_count() or 2) // FFMPEG_WORKERS)
+FFMPEG_SEM = asyncio.Semaphore(FFMPEG_WORKERS)
+_ffmpeg_waiting = 0
+
+# Конвертация идёт с пониженным приоритетом, чтобы event loop бота не ждал CPU/диск.
+# nice/ionice делают exec, так что kill по-прежнему попадает в сам ffmpeg. BOT_FFMPEG_NICE=0 — выключить.
+FFMPEG_NICE = int(os.environ.get("BOT_FFMPEG_NICE", "10"))
+_NICE_PREFIX: Tuple[str, ...] = ()
+if FFMPEG_NICE > 0 and shutil.which("nice"):
+    _NICE_PREFIX = ("nice", "-n", str(FFMPEG_NICE))
+    if shutil.which("ionice"):
+        _NICE_PREFIX += ("ionice", "-c", "2", "-n", "7")
+
+# CPU: для 480x480 и ≤59 с запас по качеству мал — ultrafast+zerolatency кодирует в разы быстрее veryfast.
+# Профиль/уровень не задаём: ultrafast всё равно отключает CABAC/B-кадры.
+# Явно фиксируем дешёвые настройки (без trellis/B-кадров, ромбовый поиск движения);
+# subme=1 почти бесплатно добавляет качества относительно subme=0 у ultrafast.
+# BOT_X264_PARAMS="" — оставить только пресет.
+X264_PARAMS = os.environ.get("BOT_X264_PARAMS", "ref=1:bframes=0:trellis=0:me=dia:subme=1")
+_X264_ARGS: Tuple[str, ...] = (
+    "-c:v", "libx264", "-preset", "ultrafast", "-tune", "zerolatency", "-crf", "28",
+    *(("-x264-params", X264_PARAMS) if X264_PARAMS else ()),
+    "-threads", str(FFMPEG_THREADS),
+)
+# -pix_fmt yuv420p явно — иначе 10-битные исходники дадут профиль, который Telegram не играет.
+_PIX_FMT_ARGS: Tuple[str, ...] = ("-pix_fmt", "yuv420p")
+
+# Без кавычек/min(): масштабируем с сохранением пропорций и дополняем паддингом до квадрата
+_CPU_FILTER = "scale=480:480:force_original_aspect_ratio=decrease,pad=480:480:(ow-iw)/2:(oh-ih)/2,setsar=1"
+
+# (кодер, аргументы до -i, фильтр, аргументы кодера) в порядке предпочтения.
+# Масштаб и паддинг для QSV/VAAPI делаем на CPU: кадр 480x480 дёшев, а
+# hw-фильтры (scale_qsv/scale_vaapi) не умеют pad и есть не в каждой сборке.
+_HW_ENCODERS: Tuple[Tuple[str, Tuple[str, ...], str, Tuple[str, ...]], ...] = (
+    ("h264_nvenc", (), _CPU_FILTER, _NVENC_ARGS + _PIX_FMT_ARGS),
+    ("h264_qsv", (), _CPU_FILTER, _QSV_ARGS),
+    ("h264_videotoolbox", (), _CPU_FILTER, _VIDEOTOOLBOX_ARGS),
+    ("h264_vaapi", ("-vaapi_device", VAAPI_DEVICE), _CPU_FILTER + ",format=nv12,hwupload", _VAAPI_ARGS),
+)
+
+def _encoder_works(input_args: Tuple[str, ...], vf: str, encoder_args: Tuple[str, ...]) -> bool:
+    # Кодер бывает вкомпилирован в ffmpeg без устройства/драйвера — кодируем один кадр
+    cmd = [
+        "ffmpeg", "-hide_banner", "-nostats", "-v", "error", *input_args,
+        "-f", "lavfi", "-i", "color=c=black:s=640x360:r=30", "-frames:v", "1",
+        "-vf", vf, *encoder_args, "-f", "null", "-",
+    ]
+    try:
+        res = subprocess.run(cmd, capture_output=True, timeout=30)
+    except (OSError, subprocess.SubprocessError):
+        return False
+    return res.returncode == 0
+
+def _pick_encoder() -> Tuple[str, Tuple[str, ...], str, Tuple[str, ...]]:
+    # BOT_VIDEO_ENCODER=h264_qsv и т.п. — взять кодер без пробного запуска; libx264 — отключить железо
+    forced = os.environ.get("BOT_VIDEO_ENCODER", "").strip()
+    for name, input_args, vf, encoder_args in _HW_ENCODERS:
+        if forced and forced != name:
+            continue
+        if name not in FFMPEG_ENCODERS:
+            continue
+        if name == "h264_vaapi" and not os.path.exists(VAAPI_DEVICE):
+            continue
+        if forced or _encoder_works(input_args, vf, encoder_args):
+            return name, input_args, vf, encoder_args
+    return "libx264", (), _CPU_FILTER, _X264_ARGS + _PIX_FMT_ARGS
+
+VIDEO_ENCODER, VIDEO_INPUT_ARGS, VIDEO_FILTER, VIDEO_ENCODER_ARGS = _pick_encoder()
+USE_NVENC = VIDEO_ENCODER == "h264_nvenc"
+
+FFMPEG_FILTERS = _ffmpeg_names("filters") if USE_NVENC else frozenset()
+
+# Цепочка целиком на GPU (вход, фильтр, кодер) или None. Используется только для входов,
+# которые NVDEC точно декодирует (_gpu_decodable); иначе и при ошибке — CPU-фильтр выше.
+GPU_CHAIN: Optional[Tuple[Tuple[str, ...], str, Tuple[str, ...]]] = None
+
+if USE_NVENC and "scale_npp" in FFMPEG_FILTERS:
+    # Кадры не покидают видеопамять: NVDEC -> scale_npp -> pad -> NVENC.
+    # Формат (yuv420p/nv12) задаёт scale_npp: -pix_fmt на CUDA-кадрах сломал бы граф.
+    if "pad_cuda" in FFMPEG_FILTERS:
+        _gpu_filter = (
+            "scale_npp=480:480:force_original_aspect_ratio=decrease:format=yuv420p,"
+            "pad_cuda=480:480:(ow-iw)/2:(oh-ih)/2,setsar=1"
+        )
+    else:
+        # старый ffmpeg без pad_cuda: паддинг на CPU, но уже по уменьшенному кадру
+        _gpu_filter = (
+            "scale_npp=480:480:force_original_aspect_ratio=decrease:format=nv12,"
+            "hwdownload,format=nv12,pad=480:480:(ow-iw)/2:(oh-ih)/2,setsar=1,hwupload_cuda"
+        )
+    # пробный кадр через ту же цепочку: старый scale_npp без force_original_aspect_ratio и т.п.
+    # отсеиваются здесь, а не на каждом видео
+    if _encoder_works(
+        ("-init_hw_device", "cuda=cu", "-filter_hw_device", "cu"),
+        "format=nv12,hwupload_cuda," + _gpu_filter,
+        _NVENC_ARGS,
+    ):
+        GPU_CHAIN = (("-hwaccel", "cuda", "-hwaccel_output_format", "cuda"), _gpu_filter, _NVENC_ARGS)
+    else:
+        log.warning("CUDA filter chain failed the test encode, using CPU filters with NVENC")
+log.info("Video encoder: %s, filter: %s", VIDEO_ENCODER, GPU_CHAIN[1] if GPU_CHAIN else VIDEO_FILTER)
+
+# NVDEC: только 8-битный 4:2:0; остальное (High10, 4:2:2, …) ffmpeg отдал бы программными
+# кадрами, и scale_npp на них упал бы
+_NVDEC_CODECS = frozenset({"h264", "hevc", "vp8", "vp9", "av1", "mpeg1video", "mpeg2video", "mpeg4", "vc1"})
+_NVDEC_PIX_FMTS = frozenset({"yuv420p", "yuvj420p", "nv12"})
+
+def _gpu_decodable(info: Dict[str, Any]) -> bool:
+    video = [st for st in info.get("streams") or [] if st.get("codec_type") == "video"]
+    return (
+        len(video) == 1
+        and video[0].get("codec_name") in _NVDEC_CODECS
+        and video[0].get("pix_fmt") in _NVDEC_PIX_FMTS
+    )
+
+FFMPEG_ERR_TAIL = 200  # сколько последних строк stderr держим для текста ошибки
+
+async def _drain(stream: asyncio.StreamReader, tail: Deque[str]) -> None:
+    # читаем stderr построчно, не копя весь вывод в памяти
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        tail.append(line.decode("utf-8", "ignore").rstrip())
+
+PIPE_BUFFER_SIZE = 1024 * 1024
+
+def _grow_pipe(writer: asyncio.StreamWriter) -> None:
+    # Linux: пайп по умолчанию 64 КБ — увеличиваем, чтобы реже будить ffmpeg
+    set_size = getattr(fcntl, "F_SETPIPE_SZ", None)
+    pipe = writer.get_extra_info("pipe")
+    if set_size is None or pipe is None:
+        return
+    try:
+        fcntl.fcntl(pipe.fileno(), set_size, PIPE_BUFFER_SIZE)
+    except OSError:
+        pass  # упёрлись в /proc/sys/fs/pipe-max-size — работаем с тем, что есть
+
+class StreamSource:
+    # Файл, который докачивается по мере чтения: начало (head) уже в памяти — по нему
+    # проверен формат и снят ffprobe, остальное идёт из HTTP-ответа прямо в stdin ffmpeg.
+    def __init__(self, head: bytes, rest: AsyncIterator[bytes]) -> None:
+        self.head = head
+        self._rest = rest
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        yield self.head
+        async for chunk in self._rest:
+            yield chunk
+
+    async def spill(self, dst: Path) -> Path:
+        # докачать в файл — когда ffmpeg нужен seek или ему ещё долго ждать очереди
+        with open(dst, "wb") as f:
+            async for chunk in self.chunks():
+                f.write(chunk)
+        return dst
+
+    async def aclose(self) -> None:
+        await self._rest.aclose()
+
+async def _feed(writer: asyncio.StreamWriter, source: StreamSource) -> None:
+    # скачивание и декодирование идут одновременно; drain() тормозит загрузку, если ffmpeg не успевает
+    try:
+        async for chunk in source.chunks():
+            writer.write(chunk)
+            await writer.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # ffmpeg завершился раньше (например, дочитав MAX_DURATION) — причину покажет stderr
+    finally:
+        writer.close()
+        await source.aclose()
+
+Source = Union[Path, StreamSource]
+
+MAX_DURATION = 59  # секунд — предел длины кружка
+
+# Фрагментированный MP4 (moov в начале, без второго прохода +faststart) можно писать прямо в stdout.
+# В нём длительность в moov нулевая, и как Telegram отображает такие кружки, не проверено —
+# поэтому по умолчанию выключен: обычный MP4 через временный файл. BOT_FRAGMENTED_MP4=1 — включить.
+FRAGMENTED_OUTPUT = os.environ.get("BOT_FRAGMENTED_MP4", "0") == "1"
+
+_AUDIO_ARGS: Tuple[str, ...] = ("-c:a", "aac", "-b:a", "96k", "-ar", "48000", "-ac", "1")
+
+def _output_args(dst: Optional[Path]) -> Tuple[str, ...]:
+    # dst=None — фрагментированный MP4 в stdout
+    if dst is None:
+        return ("-movflags", "+frag_keyframe+empty_moov+default_base_moof", "-f", "mp4", "pipe:1")
+    return ("-movflags", "+faststart", str(dst))
+
+async def ffmpeg_convert(src: Source, dst: Optional[Path], gpu: bool = False) -> Optional[bytes]:
+    # src — путь к файлу или докачиваемый поток (тогда подаём его через stdin);
+    # dst=None — результат (фрагментированный MP4) возвращается байтами из stdout;
+    # gpu=True — цепочка GPU_CHAIN вместо VIDEO_* (вызывающий проверил _gpu_decodable)
+    piped = isinstance(src, StreamSource)
+    if gpu and GPU_CHAIN is not None:
+        input_args, vf, encoder_args = GPU_CHAIN
+    else:
+        input_args, vf, encoder_args = VIDEO_INPUT_ARGS, VIDEO_FILTER, VIDEO_ENCODER_ARGS
+    # -nostats: прогресс пишется через \r без \n и превратился бы в одну бесконечную «строку»;
+    # -t перед -i: дальше MAX_DURATION вход даже не читается и не декодируется
     args = [
-        "ffmpeg", "-y",
-        "-i", str(src),
-        "-vf", "scale=480:480:force_original_aspect_ratio=decrease,pad=480:480:(ow-iw)/2:(oh-ih)/2,setsar=1",
-        "-t", "59",
-        "-r", "30",
-        "-c:v", "libx264", "-preset", "veryfast",
-        "-profile:v", "main", "-level", "3.1",
-        "-pix_fmt", "yuv420p",
-        "-c:a", "aac", "-b:a", "96k", "-ar", "48000", "-ac", "1",
-        "-movflags", "+faststart",
-        str(dst),
+        "ffmpeg", "-y", "-hide_banner", "-nostats",
+        "-filter_threads", str(FFMPEG_THREADS),
+        *input_args,
+        "-threads", str(FFMPEG_THREADS),  # потоки декодера
+        "-t", str(MAX_DURATION),
+        "-i", "pipe:0" if piped else str(src),
+        "-vf", vf,
+        "-r", "30", "-g", "60",  # ключевой кадр раз в 2 с — быстрая перемотка
+        *encoder_args,
+        *_AUDIO_ARGS,
+        *_output_args(dst),
+    ]
+    return await _run_ffmpeg(args, src if piped else None, capture=dst is None)
+
+async def ffmpeg_remux(src: Source, dst: Optional[Path], copy_audio: bool) -> Optional[bytes]:
+    # вход уже годится для кружка: видео копируем как есть, звук — копируем или кодируем в AAC.
+    # Это дело на доли секунды, поэтому без очереди FFMPEG_SEM.
+    piped = isinstance(src, StreamSource)
+    args = [
+        "ffmpeg", "-y", "-hide_banner", "-nostats",
+        "-i", "pipe:0" if piped else str(src),
+        "-map", "0:v:0", "-map", "0:a:0?",
+        "-c:v", "copy",
+        *(("-c:a", "copy") if copy_audio else _AUDIO_ARGS),
+        *_output_args(dst),
     ]
     log.info("FFmpeg cmd: %s", " ".join(args))
+    return await _exec_ffmpeg(args, src if piped else None, capture=dst is None)
+
+async def _run_ffmpeg(args: list, stdin_data: Optional[StreamSource], capture: bool) -> Optional[bytes]:
+    # ждём свободного воркера; длина очереди — в лог
+    global _ffmpeg_waiting
+    args = [*_NICE_PREFIX, *args]
+    log.info("FFmpeg cmd: %s", " ".join(args))
+    _ffmpeg_waiting += 1
+    log.info("FFmpeg queue: %d waiting, %d workers", _ffmpeg_waiting, FFMPEG_WORKERS)
+    try:
+        await FFMPEG_SEM.acquire()
+    finally:
+        _ffmpeg_waiting -= 1
+    try:
+        return await _exec_ffmpeg(args, stdin_data, capture)
+    finally:
+        FFMPEG_SEM.release()
+
+async def _exec_ffmpeg(args: list, stdin_data: Optional[StreamSource], capture: bool) -> Optional[bytes]:
     proc = await asyncio.create_subprocess_exec(
-        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        *args,
+        stdin=asyncio.subprocess.PIPE if stdin_data is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE if capture else asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
     )
-    _, err = await proc.communicate()
+    tail: Deque[str] = deque(maxlen=FFMPEG_ERR_TAIL)
+    drain = asyncio.create_task(_drain(proc.stderr, tail))
+    # stdout читаем параллельно с записью в stdin, иначе ffmpeg и мы упрёмся в полные пайпы
+    result = asyncio.create_task(proc.stdout.read()) if capture else None
+    try:
+        if stdin_data is not None:
+            _grow_pipe(proc.stdin)
+            await _feed(proc.stdin, stdin_data)
+        await proc.wait()
+        await drain
+        data = await result if result else None
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+    if proc.returncode != 0:
+        raise RuntimeError("\n".join(tail) or "ffmpeg failed")
+    return data
+
+async def _ffprobe(src: Union[Path, bytes], *args: str) -> Dict[str, Any]:
+    # для StreamSource передаётся его head: moov/заголовок контейнера уже в нём
+    # ffprobe с выводом в JSON; байты подаются через stdin. Ошибка (и отсутствие ffprobe) -> пустой
+    # словарь: вход тогда просто перекодируется полностью
+    piped = isinstance(src, bytes)
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error", *args, "-of", "json", "pipe:0" if piped else str(src),
+            stdin=asyncio.subprocess.PIPE if piped else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except OSError:
+        return {}
+    out, _ = await proc.communicate(src if piped else None)
     if proc.returncode != 0:
-        raise RuntimeError(err.decode("utf-8", "ignore") or "ffmpeg failed")
+        return {}
+    try:
+        return _json_loads(out)
+    except ValueError:
+        return {}
+
+async def _probe_media(src: Union[Path, bytes]) -> Dict[str, Any]:
+    return await _ffprobe(
+        src,
+        "-show_entries",
+        "stream=codec_type,codec_name,width,height,pix_fmt,sample_rate,channels:format=duration,format_name",
+    )
+
+def _probe_duration(info: Dict[str, Any]) -> Optional[float]:
+    try:
+        return float(info["format"]["duration"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def _copy_plan(info: Dict[str, Any]) -> Optional[bool]:
+    # None — нужен полный перекод; иначе видео копируется, а значение — можно ли копировать и звук
+    streams = info.get("streams") or []
+    video = [st for st in streams if st.get("codec_type") == "video"]
+    audio = [st for st in streams if st.get("codec_type") == "audio"]
+    duration = _probe_duration(info)
+    if len(video) != 1 or duration is None or duration > MAX_DURATION:
+        return None
+    v = video[0]
+    if (v.get("codec_name"), v.get("width"), v.get("height"), v.get("pix_fmt")) != ("h264", 480, 480, "yuv420p"):
+        return None
+    if not audio:
+        return True
+    a = audio[0]
+    return a.get("codec_name") == "aac" and a.get("channels") == 1 and a.get("sample_rate") == "48000"
+
+def _send_as_is(info: Dict[str, Any]) -> bool:
+    # MP4 с H.264 480x480 и AAC-звуком (любым) Telegram принимает как кружок без ffmpeg
+    if _copy_plan(info) is None:
+        return False
+    if "mp4" not in str((info.get("format") or {}).get("format_name", "")).split(","):
+        return False
+    streams = info.get("streams") or []
+    return all(st.get("codec_name") == "aac" for st in streams if st.get("codec_type") == "audio")
 
 # ---------- МЕДИА ----------
-async def download_media(bot: Bot, file_id: str, dst: Path) -> None:
+# BOT_STREAM_INPUT=0 — всегда сначала скачивать файл на диск
+STREAM_INPUT = os.environ.get("BOT_STREAM_INPUT", "1") != "0"
+STREAM_HEAD_MAX_BYTES = 8 * 1024 * 1024  # moov, не найденный в первых 8 МБ, ищет уже ffmpeg по файлу
+DOWNLOAD_TIMEOUT = 300  # с: поток читается со скоростью ffmpeg, а не сети
+# Больше 20 МБ облачный Bot API не отдаёт через getFile; с локальным сервером API лимит можно поднять.
+# Файлы крупнее отклоняются фильтром ещё до обработчика — без скачивания.
+MAX_INPUT_BYTES = int(os.environ.get("BOT_MAX_INPUT_MB", "20")) * 1024 * 1024
+
+def _too_big(size: Optional[int]) -> bool:
+    return (size or 0) > MAX_INPUT_BYTES
+
+_MP4_BOXES = {b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide", b"pnot"}
+
+def _moov_state(data: Union[bytes, bytearray]) -> Optional[bool]:
+    # MP4/MOV с moov после mdat из пайпа не прочитать: ffmpeg нужен seek в конец файла.
+    # True — moov целиком в data (или это не ISO BMFF: webm/mkv читаются последовательно),
+    # False — сначала идёт mdat, None — данных пока мало для решения.
+    # data — обычно растущий bytearray; его срез не хэшируется, поэтому для поиска в set — bytes()
+    if len(data) < 8:
+        return None
+    if bytes(data[4:8]) not in _MP4_BOXES:
+        return True
+    pos = 0
+    while pos + 8 <= len(data):
+        size, kind = struct.unpack_from(">I4s", data, pos)
+        if size == 1:  # 64-битный размер бокса
+            if pos + 16 > len(data):
+                return None
+            size = struct.unpack_from(">Q", data, pos + 8)[0]
+        if kind == b"mdat" or size < 8:
+            return False
+        if kind == b"moov":
+            return True if pos + size <= len(data) else None
+        pos += size
+    return None
+
+# отправка: блоки по 256 КБ вместо 64 КБ по умолчанию — в 4 раза меньше чтений/итераций на event loop
+UPLOAD_CHUNK_SIZE = 256 * 1024
+SMALL_UPLOAD_BYTES = 1024 * 1024
+
+def _upload_file(path: Path) -> InputFile:
+    # маленький файл читаем целиком, большой отдаём потоком
+    if path.stat().st_size < SMALL_UPLOAD_BYTES:
+        return BufferedInputFile(path.read_bytes(), filename=path.name, chunk_size=UPLOAD_CHUNK_SIZE)
+    return FSInputFile(path, chunk_size=UPLOAD_CHUNK_SIZE)
+
+# BOT_PARALLEL_DOWNLOAD=1 — крупные файлы качать несколькими Range-запросами параллельно
+PARALLEL_DOWNLOAD = os.environ.get("BOT_PARALLEL_DOWNLOAD") == "1"
+DOWNLOAD_PARTS = max(1, int(os.environ.get("BOT_DOWNLOAD_PARTS", "4")))
+PARALLEL_MIN_BYTES = 4 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+def _preallocate(fd: int, size: int) -> None:
+    # место под весь файл сразу: куски пишутся по своим смещениям без роста файла
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass  # ФС не умеет fallocate — обойдёмся разреженным файлом
+    os.ftruncate(fd, size)
+
+def _pwrite(fd: int, data: bytes, offset: int) -> None:
+    if hasattr(os, "pwrite"):
+        os.pwrite(fd, data, offset)
+    else:  # Windows: pwrite нет, но куски всё равно пишутся из одного потока event loop
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
+
+async def _download_ranges(bot: Bot, file_path: str, size: int, dst: Path, connections: int = DOWNLOAD_PARTS) -> bool:
+    # размер уже известен из getFile. False — сервер не поддерживает Range: качаем обычным GET
+    session = await bot.session.create_session()
+    url = bot.session.api.file_url(bot.token, file_path)
+
+    async def fetch(fd: int, lo: int, hi: int) -> bool:
+        async with session.get(url, headers={"Range": f"bytes={lo}-{hi}"}) as resp:
+            if resp.status != 206:
+                return False
+            async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                _pwrite(fd, chunk, lo)
+                lo += len(chunk)
+        return True
+
+    # один дескриптор на все куски: каждый пишет по своему смещению
+    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        _preallocate(fd, size)
+        step = -(-size // connections)
+        tasks = [asyncio.create_task(fetch(fd, lo, min(lo + step, size) - 1)) for lo in range(0, size, step)]
+        try:
+            return all(await asyncio.gather(*tasks))
+        finally:
+            for t in tasks:
+                t.cancel()
+            # дожидаемся отмены, чтобы никто не писал в уже закрытый fd
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        os.close(fd)
+
+# getFile обещает ссылку минимум на час; берём с запасом
+FILE_PATH_TTL = 45 * 60
+_FILE_CACHE: Dict[str, Tuple[File, float]] = {}
+
+async def _cached_get_file(bot: Bot, file_id: str) -> Tuple[File, bool]:
+    # (File, взят ли из кэша) — лишний HTTPS-запрос к Telegram на повторный file_id не нужен
+    now = time.monotonic()
+    hit = _FILE_CACHE.get(file_id)
+    if hit is not None and hit[1] > now:
+        return hit[0], True
     f = await bot.get_file(file_id)
+    # заодно выбрасываем просроченные записи, чтобы кэш не рос бесконечно
+    for key in [k for k, (_, expires) in _FILE_CACHE.items() if expires <= now]:
+        del _FILE_CACHE[key]
+    _FILE_CACHE[file_id] = (f, now + FILE_PATH_TTL)
+    return f, False
+
+async def download_media(bot: Bot, file_id: str, dst: Path) -> Source:
+    # Возвращает поток, если файл можно отдавать ffmpeg по мере скачивания, иначе путь dst.
+    f, cached = await _cached_get_file(bot, file_id)
+    try:
+        return await _fetch_media(bot, f, dst)
+    except ClientResponseError as e:
+        _FILE_CACHE.pop(file_id, None)
+        if not cached or e.status not in (400, 404):
+            raise
+    # ссылка из кэша протухла раньше срока — берём свежую и пробуем ещё раз
+    f, _ = await _cached_get_file(bot, file_id)
+    return await _fetch_media(bot, f, dst)
+
+async def _fetch_media(bot: Bot, f: File, dst: Path) -> Source:
+    parallel = (
+        PARALLEL_DOWNLOAD
+        and not bot.session.api.is_local
+        and (f.file_size or 0) >= PARALLEL_MIN_BYTES
+    )
+    if STREAM_INPUT and not parallel and not bot.session.api.is_local:
+        log.info("Downloading: %s -> stream", f.file_path)
+        url = bot.session.api.file_url(bot.token, f.file_path)
+        stream = bot.session.stream_content(url, timeout=DOWNLOAD_TIMEOUT, chunk_size=DOWNLOAD_CHUNK_SIZE)
+        head = bytearray()
+        state: Optional[bool] = None
+        try:
+            async for chunk in stream:
+                head += chunk
+                state = _moov_state(head)
+                if state is not None or len(head) >= STREAM_HEAD_MAX_BYTES:
+                    break
+        except BaseException:
+            await stream.aclose()
+            raise
+        source = StreamSource(bytes(head), stream)
+        if state:
+            return source
+        return await source.spill(dst)
     log.info("Downloading: %s -> %s", f.file_path, dst)
+    if parallel and await _download_ranges(bot, f.file_path, f.file_size, dst):
+        return dst
     await bot.download_file(f.file_path, dst)
+    return dst
+
+VideoMedia = Union[Video, Document, Animation]
 
-async def handle_video(message: Message, file_id: str, original_name: Optional[str]) -> None:
-    ok, _ = await _ensure_admin_access_or_explain(message)
-    if not ok:
+# ---------- КЭШ РЕЗУЛЬТАТОВ ----------
+# file_unique_id исходника -> file_id готового кружка. Одно и то же видео (пересылки в группах)
+# второй раз уходит по file_id: без скачивания, ffmpeg и загрузки. LRU на CONVERT_CACHE_MAX записей.
+CONVERT_CACHE_FILE = DATA_DIR / "convert_cache.json"
+CONVERT_CACHE_MAX = 1024
+_CONVERT_CACHE: "OrderedDict[str, str]" = OrderedDict()
+_CONVERT_CACHE_LOCK = asyncio.Lock()
+
+def _load_convert_cache() -> None:
+    # файл — JSON-объект в порядке от давно использованных к недавним
+    try:
+        raw = _json_loads(CONVERT_CACHE_FILE.read_bytes())
+    except FileNotFoundError:
         return
+    except ValueError:
+        log.warning("%s is corrupted, starting with an empty cache", CONVERT_CACHE_FILE)
+        return
+    if isinstance(raw, dict):
+        for unique_id, file_id in list(raw.items())[-CONVERT_CACHE_MAX:]:
+            _CONVERT_CACHE[str(unique_id)] = str(file_id)
+
+def _cached_note(unique_id: str) -> Optional[str]:
+    file_id = _CONVERT_CACHE.get(unique_id)
+    if file_id is not None:
+        _CONVERT_CACHE.move_to_end(unique_id)
+    return file_id
+
+async def _remember_note(unique_id: str, file_id: str) -> None:
+    _CONVERT_CACHE[unique_id] = file_id
+    _CONVERT_CACHE.move_to_end(unique_id)
+    while len(_CONVERT_CACHE) > CONVERT_CACHE_MAX:
+        _CONVERT_CACHE.popitem(last=False)
+    # снимок берём сразу, а записи идут по очереди под замком — на диске не окажется старый
+    if orjson is not None:
+        data = orjson.dumps(_CONVERT_CACHE)
+    else:
+        data = json.dumps(_CONVERT_CACHE, separators=(",", ":")).encode("utf-8")
+    async with _CONVERT_CACHE_LOCK:
+        try:
+            await asyncio.to_thread(_atomic_write, CONVERT_CACHE_FILE, data, False)
+        except OSError:
+            # кэш — необязательная оптимизация: кружок уже отправлен, в памяти запись есть
+            log.exception("Failed to write %s", CONVERT_CACHE_FILE)
+
+# ---------- ОГРАНИЧЕНИЕ ОТПРАВКИ ----------
+class TokenBucket:
+    # Не больше rate отправок в секунду в среднем, всплеск — до burst подряд.
+    # Лучше подождать здесь, чем ловить 429 от Telegram и повторять загрузку.
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._stamp = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:  # ждущие обслуживаются по очереди
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
 
+# BOT_SEND_RATE — кружков в секунду на весь бот (общий лимит Telegram ~30 сообщений/с)
+_GLOBAL_LIMITER = TokenBucket(float(os.environ.get("BOT_SEND_RATE", "20")), burst=5)
+
+async def _send_note(message: Message, note: Union[str, InputFile], duration: Optional[float] = None) -> Message:
+    # длительность передаём явно: из фрагментированного MP4 Telegram её не узнает
+    await _GLOBAL_LIMITER.acquire()
+    return await message.answer_video_note(
+        video_note=note,
+        length=480,
+        duration=round(min(duration, MAX_DURATION)) if duration else None,
+    )
+
+async def handle_video(message: Message, media: VideoMedia) -> None:
     bot: Bot = message.bot
+    cached = _cached_note(media.file_unique_id)
+    if cached is not None:
+        try:
+            await _send_note(message, cached)
+            return
+        except TelegramBadRequest:
+            # file_id больше не действителен — конвертируем заново
+            _CONVERT_CACHE.pop(media.file_unique_id, None)
     await bot.send_chat_action(message.chat.id, ChatAction.UPLOAD_VIDEO_NOTE)
 
-    with tempfile.TemporaryDirectory() as tmp:
-        tmpdir = Path(tmp)
-        suffix = Path(original_name).suffix if original_name else ".mp4"
-        src = tmpdir / f"src{suffix}"
-        out = tmpdir / "out.mp4"
+    # общий TMP_ROOT и уникальные имена вместо mkdtemp/rmtree на каждое видео
+    rid = uuid.uuid4().hex
+    suffix = Path(media.file_name).suffix if media.file_name else ".mp4"
+    src = TMP_ROOT / f"{rid}.src{suffix}"
+    out = TMP_ROOT / f"{rid}.out.mp4"
 
-        try:
-            await download_media(bot, file_id, src)
-            await ffmpeg_convert(src, out)
-            await message.answer_video_note(video_note=FSInputFile(out), length=480)
-        except Exception as e:
-            log.exception("Failed to process video")
-            await message.answer(f"⚠️ Ошибка: {e}")
+    source: Optional[Source] = None
+    try:
+        source = await download_media(bot, media.file_id, src)
+        info = await _probe_media(source.head if isinstance(source, StreamSource) else source)
+        # у video/animation длительность приходит от Telegram, у документа — из ffprobe
+        duration = getattr(media, "duration", None)
+        if duration is None:
+            duration = _probe_duration(info)
+        if duration is not None and duration > MAX_DURATION + 0.5:
+            await message.answer(f"✂️ Видео длиннее {MAX_DURATION} с — в кружок попадут первые {MAX_DURATION} с.")
+
+        if _send_as_is(info):
+            if isinstance(source, StreamSource):
+                source = await source.spill(src)
+            sent = await _send_note(message, _upload_file(source), duration)
+            if sent.video_note:
+                await _remember_note(media.file_unique_id, sent.video_note.file_id)
+            return
+
+        # уже 480x480 H.264, но в другом контейнере или с другим звуком — перепаковка без перекодирования
+        copy_audio = _copy_plan(info)
+        target = None if FRAGMENTED_OUTPUT else out
+        if copy_audio is None:
+            if isinstance(source, StreamSource) and FFMPEG_SEM.locked():
+                # в очереди к ffmpeg соединение простаивало бы до таймаута — докачиваем в файл
+                source = await source.spill(src)
+            gpu = GPU_CHAIN is not None and _gpu_decodable(info)
+            try:
+                data = await ffmpeg_convert(source, target, gpu)
+            except RuntimeError:
+                if not gpu:
+                    raise
+                # NVDEC/scale_npp не справились с этим входом — тот же NVENC, но фильтры на CPU
+                log.warning("CUDA filter chain failed, retrying with CPU filters", exc_info=True)
+                if isinstance(source, StreamSource):
+                    # поток уже прочитан ffmpeg — качаем заново
+                    await source.aclose()
+                    source = await download_media(bot, media.file_id, src)
+                data = await ffmpeg_convert(source, target)
+        else:
+            data = await ffmpeg_remux(source, target, copy_audio)
+        if FRAGMENTED_OUTPUT:
+            note = BufferedInputFile(data, filename="note.mp4", chunk_size=UPLOAD_CHUNK_SIZE)
+        else:
+            note = _upload_file(out)
+        sent = await _send_note(message, note, duration)
+        if sent.video_note:
+            await _remember_note(media.file_unique_id, sent.video_note.file_id)
+    except Exception as e:
+        log.exception("Failed to process video")
+        await message.answer(f"⚠️ Ошибка: {e}")
+    finally:
+        if isinstance(source, StreamSource):
+            await source.aclose()
+        src.unlink(missing_ok=True)
+        out.unlink(missing_ok=True)
+
+# ---------- ФОНОВАЯ ОБРАБОТКА ----------
+# Видео обрабатываются фоновыми задачами: обработчик апдейта возвращается сразу.
+# В одном чате — строго по очереди, разные чаты — параллельно
+# (число одновременных кодирований ограничивает FFMPEG_SEM).
+# От одного пользователя — одно видео за раз: лишние отклоняются, а не копятся в очереди.
+_CHAT_LOCKS: "weakref.WeakValueDictionary[int, asyncio.Semaphore]" = weakref.WeakValueDictionary()
+_USER_LOCKS: "weakref.WeakValueDictionary[int, asyncio.Semaphore]" = weakref.WeakValueDictionary()
+_BACKGROUND_TASKS: Set["asyncio.Task[None]"] = set()
+
+def _lock_for(locks: "weakref.WeakValueDictionary[int, asyncio.Semaphore]", key: int) -> asyncio.Semaphore:
+    # семафор живёт, пока на него ссылается хотя бы одна задача — простаивающие удаляются сами
+    lock = locks.get(key)
+    if lock is None:
+        lock = locks[key] = asyncio.Semaphore(1)
+    return lock
+
+async def _wrapped_handle_video(message: Message, media: VideoMedia) -> None:
+    user_id = message.from_user.id if message.from_user else message.chat.id
+    user_lock = _lock_for(_USER_LOCKS, user_id)
+    chat_lock = _lock_for(_CHAT_LOCKS, message.chat.id)
+    try:
+        if user_lock.locked():
+            await message.answer("⏳ Предыдущее видео ещё обрабатывается — пришли это чуть позже.")
+            return
+        async with user_lock, chat_lock:
+            await handle_video(message, media)
+    except Exception:
+        log.exception("Video task failed")
+
+def spawn_video_task(message: Message, media: VideoMedia) -> None:
+    task = asyncio.create_task(_wrapped_handle_video(message, media))
+    # держим ссылку, иначе незавершённую задачу может собрать GC
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
 
 # ---------- КОМАНДЫ СУПЕР-АДМИНА ----------
-def _parse_target(arg: str) -> Tuple[Optional[int], Optional[str]]:
-    arg = arg.strip()
-    if not arg:
+# аргумент команды (CommandObject.args — /команда и @бот aiogram уже отрезал):
+# числовой ID или username (с @ или без) — разбор за один проход
+_TARGET_RE = re.compile(r"\s*(?:(-?\d+)|@?(\w+))\s*")
+
+def _parse_target(args: Optional[str]) -> Tuple[Optional[int], Optional[str]]:
+    mo = _TARGET_RE.fullmatch(args or "")
+    if mo is None:
         return None, None
-    if arg.startswith("@"):
-        return None, arg.lstrip("@").lower()
-    try:
-        return int(arg), None
-    except ValueError:
-        # может прислали просто username без @
-        return None, arg.lower()
+    uid, uname = mo.groups()
+    if uid is not None:
+        return int(uid), None
+    return None, uname.lower()
+
+def _has_target(block: Dict[str, Any], uid: Optional[int], uname: Optional[str]) -> bool:
+    if uid is not None:
+        return uid in block["ids_set"]
+    return uname in block["usernames_set"]
 
 @_require_super
-async def cmd_grant_admin(m: Message, access: Dict[str, Any]):
+async def cmd_grant_admin(m: Message, access: Dict[str, Any], command: CommandObject):
     """ /grant_admin @username | /grant_admin 123456 """
-    parts = m.text.split(maxsplit=1)
-    if len(parts) < 2:
-        await m.answer("Использование: /grant_admin @username | /grant_admin <id>")
-        return
-    uid, uname = _parse_target(parts[1])
+    uid, uname = _parse_target(command.args)
     if uid is None and not uname:
-        await m.answer("Укажи @username или числовой ID.")
+        await m.answer("Использование: /grant_admin @username | /grant_admin <id>")
         return
 
     admins = access["admins"]
+    who = f"@{uname}" if uname else uid
+    if _has_target(admins, uid, uname):
+        await m.answer(f"ℹ️ {who} уже админ.")
+        return
     if uid is not None:
-        admins["ids"] = sorted(set(admins["ids"]) | {uid})
+        admins["ids_set"] = admins["ids_set"] | {uid}
     if uname:
-        admins["usernames"] = sorted(set(admins["usernames"]) | {uname})
+        admins["usernames_set"] = admins["usernames_set"] | {uname}
 
     await _save_access(access)
-    who = f"@{uname}" if uname else uid
     await m.answer(f"✅ Выдан доступ АДМИНА: {who}")
 
 @_require_super
-async def cmd_revoke_admin(m: Message, access: Dict[str, Any]):
+async def cmd_revoke_admin(m: Message, access: Dict[str, Any], command: CommandObject):
     """ /revoke_admin @username | /revoke_admin 123456 """
-    parts = m.text.split(maxsplit=1)
-    if len(parts) < 2:
+    uid, uname = _parse_target(command.args)
+    if uid is None and not uname:
         await m.answer("Использование: /revoke_admin @username | /revoke_admin <id>")
         return
-    uid, uname = _parse_target(parts[1])
     admins = access["admins"]
+    who = f"@{uname}" if uname else uid
+    if not _has_target(admins, uid, uname):
+        await m.answer(f"ℹ️ {who} и так не админ.")
+        return
     if uid is not None:
-        admins["ids"] = sorted({i for i in admins["ids"] if i != uid})
+        admins["ids_set"] = admins["ids_set"] - {uid}
     if uname:
-        admins["usernames"] = sorted({u for u in admins["usernames"] if u != uname})
+        admins["usernames_set"] = admins["usernames_set"] - {uname}
 
     await _save_access(access)
-    who = f"@{uname}" if uname else uid
     await m.answer(f"✅ Отозван доступ АДМИНА: {who}")
 
 @_require_super
-async def cmd_grant_super(m: Message, access: Dict[str, Any]):
+async def cmd_grant_super(m: Message, access: Dict[str, Any], command: CommandObject):
     """ /grant_super @username | /grant_super 123456 """
-    parts = m.text.split(maxsplit=1)
-    if len(parts) < 2:
+    uid, uname = _parse_target(command.args)
+    if uid is None and not uname:
         await m.answer("Использование: /grant_super @username | /grant_super <id>")
         return
-    uid, uname = _parse_target(parts[1])
 
     sup = access["super"]
+    who = f"@{uname}" if uname else uid
+    if _has_target(sup, uid, uname):
+        await m.answer(f"ℹ️ {who} уже супер-админ.")
+        return
     if uid is not None:
-        sup["ids"] = sorted(set(sup["ids"]) | {uid})
+        sup["ids_set"] = sup["ids_set"] | {uid}
     if uname:
-        sup["usernames"] = sorted(set(sup["usernames"]) | {uname})
+        sup["usernames_set"] = sup["usernames_set"] | {uname}
 
     await _save_access(access)
-    who = f"@{uname}" if uname else uid
     await m.answer(f"✅ Выдан доступ СУПЕР-АДМИНА: {who}")
 
 @_require_super
-async def cmd_revoke_super(m: Message, access: Dict[str, Any]):
+async def cmd_revoke_super(m: Message, access: Dict[str, Any], command: CommandObject):
     """ /revoke_super @username | /revoke_super 123456 """
-    parts = m.text.split(maxsplit=1)
-    if len(parts) < 2:
+    uid, uname = _parse_target(command.args)
+    if uid is None and not uname:
         await m.answer("Использование: /revoke_super @username | /revoke_super <id>")
         return
-    uid, uname = _parse_target(parts[1])
 
     # Защита: не позволяем убрать последнего супер-админа
     def count_sup(a: Dict[str, Any]) -> int:
-        return len(a["super"]["ids"]) + len(a["super"]["usernames"])
+        return len(a["super"]["ids_set"]) + len(a["super"]["usernames_set"])
 
-    before = count_sup(access)
     sup = access["super"]
+    who = f"@{uname}" if uname else uid
+    if not _has_target(sup, uid, uname):
+        await m.answer(f"ℹ️ {who} и так не супер-админ.")
+        return
 
     if uid is not None:
-        sup["ids"] = sorted({i for i in sup["ids"] if i != uid})
+        sup["ids_set"] = sup["ids_set"] - {uid}
     if uname:
-        sup["usernames"] = sorted({u for u in sup["usernames"] if u != uname})
+        sup["usernames_set"] = sup["usernames_set"] - {uname}
 
     if count_sup(access) == 0:
         await m.answer("⛔ Нельзя удалить последнего супер-админа.")
         return
 
     await _save_access(access)
-    who = f"@{uname}" if uname else uid
     await m.answer(f"✅ Отозван доступ СУПЕР-АДМИНА: {who}")
 
 @_require_super
@@ -306,90 +1225,137 @@ async def cmd_list_roles(m: Message, access: Dict[str, Any]):
     txt = ["📜 Роли доступа:"]
     txt.append("\n🔶 Супер-админы:")
     lines = []
-    if s["usernames"]:
-        lines += [f"  • @{u}" for u in s["usernames"]]
-    if s["ids"]:
-        lines += [f"  • {i}" for i in s["ids"]]
+    lines += [f"  • @{u}" for u in sorted(s["usernames_set"])]
+    lines += [f"  • {i}" for i in sorted(s["ids_set"])]
     txt += lines or ["  —"]
 
     txt.append("\n🔹 Админы:")
     lines = []
-    if a["usernames"]:
-        lines += [f"  • @{u}" for u in a["usernames"]]
-    if a["ids"]:
-        lines += [f"  • {i}" for i in a["ids"]]
+    lines += [f"  • @{u}" for u in sorted(a["usernames_set"])]
+    lines += [f"  • {i}" for i in sorted(a["ids_set"])]
     txt += lines or ["  —"]
 
     await m.answer("\n".join(txt))
 
-async def cmd_whoami(m: Message):
-    acc = _load_access()
-    role = "супер-админ" if is_super(m, acc) else ("админ" if is_admin(m, acc) else "нет доступа")
-    uname = f"@{m.from_user.username}" if m.from_user.username else "(нет username)"
-    await m.answer(f"Вы: {uname}\nID: {m.from_user.id}\nРоль: {role}")
+async def cmd_whoami(m: Message, sup: bool, adm: bool):
+    role = "супер-админ" if sup else ("админ" if adm else "нет доступа")
+    u = m.from_user
+    if u is None:
+        await m.answer(f"Вы пишете анонимно (от имени чата {m.chat.id})\nРоль: {role}")
+        return
+    uname = f"@{u.username}" if u.username else "(нет username)"
+    await m.answer(f"Вы: {uname}\nID: {u.id}\nРоль: {role}")
 
 # ---------- MAIN ----------
+# WEBHOOK_URL задан (https://example.com, TLS снимает reverse proxy) — Telegram сам присылает апдейты
+# на WEBHOOK_HOST:WEBHOOK_PORT; не задан — long polling.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8080"))
+ALLOWED_UPDATES = ["message"]
+
+async def run_webhook(bot: Bot, dp: Dispatcher) -> None:
+    # секрет и в пути (/tg/<secret>), и в заголовке X-Telegram-Bot-Api-Secret-Token
+    secret = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+    path = f"/tg/{secret}"
+    app = web.Application()
+    # каждый апдейт обрабатывается отдельной задачей, Telegram получает ответ сразу
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=path)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + path,
+            secret_token=secret,
+            drop_pending_updates=True,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+        log.info("Webhook: %s/tg/… -> %s:%s", WEBHOOK_URL.rstrip("/"), WEBHOOK_HOST, WEBHOOK_PORT)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 async def main() -> None:
     token = os.environ.get("BOT_TOKEN")
     if not token:
         raise RuntimeError("Не задан BOT_TOKEN (переменная окружения).")
     bot = Bot(token)
     dp = Dispatcher()
+    dp.message.middleware(AuthMiddleware())
+    dp.startup.register(_start_access_flusher)
+    dp.shutdown.register(_stop_access_flusher)
+    # прогреваем кэш доступа до первых апдейтов
+    await _load_access()
+    _load_convert_cache()
 
     # базовые
     @dp.message(Command("start", "help"))
     async def start(m: Message):
-        await m.answer(
-            "Отправь видео — сделаю кружок Telegram.\n\n"
-            "Роли:\n"
-            "• Супер-админ — команды и конвертация\n"
-            "• Админ — только конвертация\n"
-            "• Остальным — доступ закрыт",
-            reply_markup=MAIN_KB
-        )
+        await m.answer(WELCOME_TEXT, reply_markup=MAIN_KB)
 
     @dp.message(Command("whoami"))
-    async def who(m: Message):
-        await cmd_whoami(m)
+    async def who(m: Message, is_super: bool, is_admin: bool):
+        await cmd_whoami(m, is_super, is_admin)
 
     # команды СУПЕР-АДМИНА
     @dp.message(Command("grant_admin"))
-    async def _ga(m: Message): await cmd_grant_admin(m)
+    async def _ga(m: Message, access: Dict[str, Any], command: CommandObject): await cmd_grant_admin(m, access, command)
     @dp.message(Command("revoke_admin"))
-    async def _ra(m: Message): await cmd_revoke_admin(m)
+    async def _ra(m: Message, access: Dict[str, Any], command: CommandObject): await cmd_revoke_admin(m, access, command)
     @dp.message(Command("grant_super"))
-    async def _gs(m: Message): await cmd_grant_super(m)
+    async def _gs(m: Message, access: Dict[str, Any], command: CommandObject): await cmd_grant_super(m, access, command)
     @dp.message(Command("revoke_super"))
-    async def _rs(m: Message): await cmd_revoke_super(m)
+    async def _rs(m: Message, access: Dict[str, Any], command: CommandObject): await cmd_revoke_super(m, access, command)
     @dp.message(Command("list_roles"))
-    async def _lr(m: Message): await cmd_list_roles(m)
+    async def _lr(m: Message, access: Dict[str, Any]): await cmd_list_roles(m, access)
 
     # кнопки
-    @dp.message(F.text == "🎥 Конвертировать видео"))
+    @dp.message(F.text == BTN_CONVERT, flags={"admin": True})
     async def ask(m: Message):
-        ok, _ = await _ensure_admin_access_or_explain(m)
-        if ok:
-            await m.answer("Жду видео или пересланное видео.", reply_markup=MAIN_KB)
+        await m.answer(PROMPT_TEXT, reply_markup=MAIN_KB)
 
-    @dp.message(F.text == "ℹ️ Помощь")
+    @dp.message(F.text == BTN_HELP)
     async def help_(m: Message):
-        await m.answer("Установи ffmpeg. Доступ только для ролей (админ/супер-админ).", reply_markup=MAIN_KB)
+        await m.answer(HELP_TEXT, reply_markup=MAIN_KB)
 
     # медиа
-    @dp.message(F.video)
+    @dp.message(
+        F.video.file_size.func(_too_big)
+        | F.animation.file_size.func(_too_big)
+        | (F.document.mime_type.startswith("video/") & F.document.file_size.func(_too_big)),
+        flags={"admin": True},
+    )
+    async def too_big(m: Message):
+        await m.answer(f"📦 Файл слишком большой: лимит {MAX_INPUT_BYTES // (1024 * 1024)} МБ.")
+
+    @dp.message(F.video, flags={"admin": True})
     async def vid(m: Message):
-        await handle_video(m, m.video.file_id, m.video.file_name)
+        spawn_video_task(m, m.video)
 
-    @dp.message(F.document & F.document.mime_type.startswith("video/"))
+    @dp.message(F.document & F.document.mime_type.startswith("video/"), flags={"admin": True})
     async def doc(m: Message):
-        await handle_video(m, m.document.file_id, m.document.file_name)
+        spawn_video_task(m, m.document)
 
-    @dp.message(F.animation)
+    @dp.message(F.animation, flags={"admin": True})
     async def anim(m: Message):
-        await handle_video(m, m.animation.file_id, m.animation.file_name)
+        spawn_video_task(m, m.animation)
 
+    if WEBHOOK_URL:
+        await run_webhook(bot, dp)
+        return
     log.info("Starting polling…")
-    await dp.start_polling(bot, skip_updates=True)
+    # в aiogram 3 skip_updates у start_polling нет (уходил в kwargs хэндлеров) — старые апдейты
+    # сбрасываем через deleteWebhook; long polling на 50 с, только сообщения, апдейты — задачами
+    await bot.delete_webhook(drop_pending_updates=True)
+    await dp.start_polling(
+        bot,
+        allowed_updates=ALLOWED_UPDATES,
+        polling_timeout=50,
+        handle_as_tasks=True,
+    )
 
 if __name__ == "__main__":
     asyncio.run(main())
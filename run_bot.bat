@@ -67,6 +67,10 @@ if %errorlevel% NEQ 0 (
   pause
   exit /b 1
 )
+where ffprobe >nul 2>nul
+if %errorlevel% NEQ 0 (
+  echo [WARN] ffprobe не найден в PATH: бот будет работать, но каждое видео будет перекодироваться целиком.
+)
 
 REM === Set bot token (your token) ===
 set "BOT_TOKEN=7964488864:AAEVEbs9zWzipTgNR3HMIKAw1pR6Hpg8qyM"
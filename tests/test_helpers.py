@@ -0,0 +1,108 @@
+# Тесты чистых помощников bot.py (без сети, ffmpeg и Telegram).
+# Запуск: python -m unittest discover -s tests  (или pytest)
+import struct
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bot  # noqa: E402
+
+
+def _box(kind: bytes, payload: bytes = b"") -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+class MoovStateTest(unittest.TestCase):
+    def test_moov_first(self):
+        data = bytearray(_box(b"ftyp", b"isom0000") + _box(b"moov", b"x" * 16))
+        self.assertIs(bot._moov_state(data), True)
+
+    def test_mdat_first(self):
+        data = bytearray(_box(b"ftyp", b"isom0000") + _box(b"mdat", b"x" * 16))
+        self.assertIs(bot._moov_state(data), False)
+
+    def test_partial_moov_undecided(self):
+        data = bytearray(_box(b"ftyp", b"isom0000") + _box(b"moov", b"x" * 16)[:12])
+        self.assertIsNone(bot._moov_state(data))
+
+    def test_too_short(self):
+        self.assertIsNone(bot._moov_state(bytearray(b"\x00\x00")))
+
+    def test_not_iso_bmff(self):
+        # webm/mkv: EBML-заголовок, читается последовательно
+        self.assertIs(bot._moov_state(bytearray(b"\x1aE\xdf\xa3" + b"\x00" * 8)), True)
+
+    def test_bytes_input(self):
+        self.assertIs(bot._moov_state(_box(b"ftyp", b"isom0000") + _box(b"moov")), True)
+
+
+class ParseTargetTest(unittest.TestCase):
+    def test_username(self):
+        self.assertEqual(bot._parse_target("@Foo"), (None, "foo"))
+        self.assertEqual(bot._parse_target("bar"), (None, "bar"))
+
+    def test_id(self):
+        self.assertEqual(bot._parse_target(" 123 "), (123, None))
+        self.assertEqual(bot._parse_target("-100"), (-100, None))
+
+    def test_invalid(self):
+        self.assertEqual(bot._parse_target(None), (None, None))
+        self.assertEqual(bot._parse_target(""), (None, None))
+        self.assertEqual(bot._parse_target("a b"), (None, None))
+
+
+class ParseAccessTest(unittest.TestCase):
+    def test_valid(self):
+        acc = bot._parse_access(b'{"super":{"ids":[1],"usernames":["@Boss"]},"admins":{"ids":["2"]}}')
+        self.assertEqual(acc["super"]["ids_set"], frozenset({1}))
+        self.assertEqual(acc["super"]["usernames_set"], frozenset({"boss"}))
+        self.assertEqual(acc["admins"]["ids_set"], frozenset({2}))
+
+    def test_lenient_unknown_keys_and_numeric_username(self):
+        acc = bot._parse_access(b'{"super":{"ids":[1],"usernames":[123]},"admins":{},"note":"x"}')
+        self.assertEqual(set(acc), {"super", "admins"})
+        self.assertEqual(acc["super"]["usernames_set"], frozenset({"123"}))
+        # копия и сериализация не должны падать на таком файле
+        self.assertEqual(bot._copy_access(acc), acc)
+        self.assertEqual(bot._serialize_access(acc)["super"], {"ids": [1], "usernames": ["123"]})
+
+    def test_bad_blocks_are_empty(self):
+        for raw in (b'{"super":{"ids":5},"admins":null}', b'{"admins":[]}', b"[1]"):
+            acc = bot._parse_access(raw)
+            self.assertEqual(acc["super"]["ids_set"], frozenset())
+            self.assertEqual(acc["admins"]["usernames_set"], frozenset())
+
+    def test_invalid_json_raises(self):
+        with self.assertRaises(ValueError):
+            bot._parse_access(b"{broken")
+
+
+def _info(width=480, height=480, duration="10.0", audio=None):
+    streams = [{"codec_type": "video", "codec_name": "h264", "width": width, "height": height, "pix_fmt": "yuv420p"}]
+    if audio is not None:
+        streams.append(dict(audio, codec_type="audio"))
+    return {"streams": streams, "format": {"duration": duration}}
+
+
+class CopyPlanTest(unittest.TestCase):
+    def test_audio_copyable(self):
+        info = _info(audio={"codec_name": "aac", "channels": 1, "sample_rate": "48000"})
+        self.assertIs(bot._copy_plan(info), True)
+
+    def test_audio_needs_encode(self):
+        info = _info(audio={"codec_name": "aac", "channels": 2, "sample_rate": "44100"})
+        self.assertIs(bot._copy_plan(info), False)
+
+    def test_no_audio(self):
+        self.assertIs(bot._copy_plan(_info()), True)
+
+    def test_needs_full_encode(self):
+        self.assertIsNone(bot._copy_plan(_info(width=1280, height=720)))
+        self.assertIsNone(bot._copy_plan(_info(duration="120")))
+        self.assertIsNone(bot._copy_plan({}))
+
+
+if __name__ == "__main__":
+    unittest.main()